@@ -2,43 +2,160 @@
 
 import subprocess
 import argparse
+import hashlib
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from time import monotonic_ns
+
+
+print_lock = threading.Lock()
 
 
 def cmd(*args, **kwargs):
-	print(args, kwargs)
-	p = subprocess.Popen(args, **kwargs)
-	return p.wait()
+	with print_lock:
+		print(args, kwargs)
+	return subprocess.run(args, **kwargs).returncode
 
 def git(*args, **kwargs):
-	if cmd("git", *args, **kwargs) != 0:
-		raise Exception(f"git command failed: {' '.join(args)} {kwargs}")
+	with print_lock:
+		print(("git", *args), kwargs)
+	# output is captured and printed in one go so that the output of concurrent pulls doesn't interleave
+	p = subprocess.run(("git", *args), stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace", **kwargs)
+	if p.stdout:
+		with print_lock:
+			print(p.stdout, end="")
+	if p.returncode != 0:
+		raise Exception(f"git command failed: {' '.join(map(str, args))} {kwargs}")
+
+def git_output(*args, **kwargs):
+	with print_lock:
+		print(("git", *args), kwargs)
+	p = subprocess.run(("git", *args), stdout=subprocess.PIPE, text=True, **kwargs)
+	if p.returncode != 0:
+		raise Exception(f"git command failed: {' '.join(map(str, args))} {kwargs}")
+	return p.stdout.strip()
+
+def git_up_to_date(dir, remote_dir, branch):
+	# one ls-remote round trip is much cheaper than fetching and merging nothing
+	remote = git_output("ls-remote", "origin", f"refs/heads/{branch}", cwd=remote_dir).split()
+	return bool(remote) and remote[0] == git_output("rev-parse", "HEAD", cwd=dir)
+
+mirrors_dir = Path(__file__).parent/".cache"/"mirrors"
+
+def pull_git_dependency(dir, url, *, branch = "main", sparse = None):
+	if (dir/".git").is_dir():
+		# standalone clone from before mirrors were used
+		if not git_up_to_date(dir, dir, branch):
+			git("pull", "--ff-only", "origin", branch, cwd=dir)
+		return
+
+	# checkouts are worktrees of a bare mirror so that all checkouts of the same repository share one object store,
+	# mirrors are named after host and path so that forks of a repository don't share one
+	mirror = mirrors_dir/re.sub(r"[^\w.-]+", "_", re.sub(r"^\w+://", "", url)).strip("_")
+	if not mirror.exists():
+		mirror.parent.mkdir(parents=True, exist_ok=True)
+		git("clone", "--bare", "--filter=blob:none", "--depth=1", "-b", branch, url, mirror)
+	elif dir.exists() and git_up_to_date(dir, mirror, branch):
+		return
+
+	git("fetch", "origin", f"+refs/heads/{branch}:refs/remotes/origin/{branch}", cwd=mirror)
 
-def pull_git_dependency(dir, url, *, branch = "main"):
 	if dir.exists():
-		git("fetch", cwd=dir)
-		git("checkout", branch, cwd=dir)
-		git("merge", f"origin/{branch}", "--ff-only", cwd=dir)
+		git("merge", "--ff-only", f"origin/{branch}", cwd=dir)
+		return
+
+	# forget worktrees whose directory was deleted, otherwise they can't be added again
+	git("worktree", "prune", cwd=mirror)
+
+	if sparse:
+		# only check out the given directories (plus all top-level files)
+		git("worktree", "add", "--no-checkout", "--detach", dir, f"origin/{branch}", cwd=mirror)
+		git("sparse-checkout", "set", "--cone", *sparse, cwd=dir)
+		git("reset", "--hard", cwd=dir)
 	else:
-		git("clone", url, dir, "-b", branch)
+		git("worktree", "add", "--detach", dir, f"origin/{branch}", cwd=mirror)
+
+def cmake_var_def_arg(name, value):
+	match value:
+		case bool(): return f"-D{name}={'ON' if value else 'OFF'}"
+		case Path(): return f"-D{name}:PATH={value}" # necessary so that cmake deals with \ correctly
+		case _: return f"-D{name}={value}"
 
 def cmake_var_def_args(vars):
-	for name, value in vars.items():
-		match value:
-			case Path(): yield f"-D{name}:PATH={value}" # necessary so that cmake deals with \ correctly
-			case _: yield f"-D{name}={value}"
+	return [cmake_var_def_arg(name, value) for name, value in vars.items()]
+
+def compiler_launcher_vars():
+	# sccache rather than ccache since it supports clang-cl
+	if shutil.which("sccache"):
+		return dict(CMAKE_C_COMPILER_LAUNCHER="sccache", CMAKE_CXX_COMPILER_LAUNCHER="sccache")
+	return dict()
+
+def parallel_link_jobs():
+	# linking LLVM/clang binaries takes up to ~8 GiB each
+	try:
+		import psutil
+	except ImportError:
+		return 2
+	return max(psutil.virtual_memory().total // (8 * 2**30), 1)
 
 def cmake_configure(build_dir, source_dir, configs, **vars):
-	if cmd("cmake", "-G", "Ninja", "-DCMAKE_BUILD_TYPE=Release", *tuple(cmake_var_def_args(vars)), source_dir, cwd=build_dir) != 0:
+	args = ("cmake", "-G", "Ninja", "-DCMAKE_BUILD_TYPE=Release", *cmake_var_def_args(vars), source_dir)
+
+	# skip configure if the existing cache was generated from the same arguments, cmake will rerun itself if any CMakeLists.txt changed
+	configure_hash = hashlib.sha256("\0".join(map(str, args)).encode()).hexdigest()
+	hash_file = build_dir/".configure-hash"
+	if (build_dir/"CMakeCache.txt").exists() and hash_file.exists() and hash_file.read_text() == configure_hash:
+		return
+
+	# cmake may change the cache even if it fails, so the old hash must not survive a failed configure
+	hash_file.unlink(missing_ok=True)
+
+	if cmd(*args, cwd=build_dir) != 0:
 		raise Exception(f"cmake command failed: {build_dir} {source_dir} {configs} {vars}")
 
+	hash_file.write_text(configure_hash)
+
+ninja_status = re.compile(r"\[\d+/\d+\] ")
+
 def ninja(build_dir, *targets):
-	from time import monotonic_ns
+	args = ("ninja", *targets)
+	with print_lock:
+		print(args, dict(cwd=build_dir))
+
 	t_start = monotonic_ns()
-	if cmd("ninja", *targets, cwd=build_dir) != 0:
+
+	# writing to the console is slow on Windows and holds up ninja, so progress lines overwrite each other and only other output is printed in full
+	p = subprocess.Popen(args, cwd=build_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors="replace", bufsize=1, env=os.environ | dict(NINJA_STATUS="[%f/%t] "))
+	# only a terminal can redraw a line in place, anywhere else (e.g. log files) every line is printed as is
+	interactive = sys.stdout.isatty()
+	width = shutil.get_terminal_size().columns - 1
+	status_len = 0
+	for line in p.stdout:
+		line = line.rstrip("\n")
+		with print_lock:
+			if interactive and ninja_status.match(line):
+				status = line[:width]
+				print(f"\r{status:<{status_len}}", end="", flush=True)
+				status_len = len(status)
+			else:
+				if status_len:
+					print()
+					status_len = 0
+				print(line)
+	if status_len:
+		print()
+
+	if p.wait() != 0:
 		raise Exception(f"ninja failed: {build_dir} {targets}")
 	t_end = monotonic_ns()
-	print(f"time elapsed: {(t_end - t_start) / 1e9} s")
+	with print_lock:
+		print(f"time elapsed: {(t_end - t_start) / 1e9} s")
 
 
 tools = dict()
@@ -56,9 +173,9 @@ class Ninja:
 		self.build_dir = dir
 
 	def pull(self):
-		pull_git_dependency(self.source_dir, "https://github.com/ninja-build/ninja.git", branch="master")
+		pull_git_dependency(self.source_dir, "https://github.com/ninja-build/ninja.git", branch="master", sparse=["src", "misc"])
 
-	def configure(self, configs):
+	def configure(self, configs, **options):
 		pass
 
 	def build(self, configs):
@@ -70,6 +187,9 @@ class Ninja:
 
 @tool
 class LLVM:
+	# tools from llvm/tools that nobody uses, skipped entirely to save compile and link time
+	unused_tools = ["bugpoint", "llvm-exegesis", "llvm-reduce", "llvm-xray", "llvm-jitlink"]
+
 	def __init__(self, dir):
 		dir.mkdir(exist_ok=True)
 		self.source_dir = dir/"src"
@@ -77,36 +197,81 @@ class LLVM:
 		self.install_dir = dir
 
 	def pull(self):
-		pull_git_dependency(self.source_dir, "https://github.com/llvm/llvm-project.git")
+		pull_git_dependency(self.source_dir, "https://github.com/llvm/llvm-project.git", sparse=["llvm", "clang", "clang-tools-extra", "lld", "libunwind", "cmake", "third-party", "runtimes"])
 
-	def configure(self, configs):
-		self.build_dir.mkdir(exist_ok=True)
+	def configure_build(self, build_dir, configs, **vars):
+		build_dir.mkdir(exist_ok=True)
 
-		cmake_configure(self.build_dir, self.source_dir/"llvm", configs,
+		cmake_configure(build_dir, self.source_dir/"llvm", configs, **(dict(
 			CMAKE_C_COMPILER="clang-cl",
 			CMAKE_CXX_COMPILER="clang-cl",
 			CMAKE_INSTALL_PREFIX=self.install_dir,
 			LLVM_OPTIMIZED_TABLEGEN=True,
 			LLVM_ENABLE_LLD=True,
+			LLVM_PARALLEL_LINK_JOBS=parallel_link_jobs(),
+			LLVM_PARALLEL_TABLEGEN_JOBS=max(os.cpu_count() // 4, 1),
 			LLVM_TARGETS_TO_BUILD="X86;AArch64;NVPTX",
 			LLVM_ENABLE_PROJECTS="clang;clang-tools-extra;lld",
 			LLVM_ENABLE_BINDINGS=False,
-			LLVM_INCLUDE_TOOLS=True,
-			LLVM_INCLUDE_TESTS=False,
+			LLVM_BUILD_UTILS=False,
+			LLVM_BUILD_RUNTIME=False,
+			LLVM_INCLUDE_TESTS=False, # also covers clang
 			LLVM_INCLUDE_BENCHMARKS=False,
 			LLVM_INCLUDE_EXAMPLES=False,
-			LLVM_INCLUDE_DOCS=False,
-			CLANG_INCLUDE_TESTS=False,
-			CLANG_INCLUDE_DOCS=False,
+			LLVM_INCLUDE_DOCS=False, # also covers clang
+			**{f"LLVM_TOOL_{name.upper().replace('-', '_')}_BUILD": False for name in self.unused_tools},
+		) | compiler_launcher_vars() | vars))
+
+	def profile(self, configs):
+		# reuse an existing profile, delete it to retrain
+		profdata = self.build_dir.with_name("clang.profdata")
+		if profdata.exists():
+			return profdata
+
+		instrumented_dir = self.build_dir.with_name("build-instrumented")
+		self.configure_build(instrumented_dir, configs,
+			LLVM_ENABLE_PROJECTS="clang;lld",
+			LLVM_BUILD_INSTRUMENTED="IR",
+		)
+		ninja(instrumented_dir, "clang", "lld")
+
+		# profiles from earlier (re)builds of the instrumented compiler would otherwise be merged in as well
+		shutil.rmtree(instrumented_dir/"profiles", ignore_errors=True)
+
+		# train by compiling LLVMSupport with the instrumented compiler, no compiler cache so that everything actually gets compiled
+		training_dir = self.build_dir.with_name("build-training")
+		self.configure_build(training_dir, configs,
+			CMAKE_C_COMPILER=instrumented_dir/"bin"/"clang-cl.exe",
+			CMAKE_CXX_COMPILER=instrumented_dir/"bin"/"clang-cl.exe",
+			CMAKE_C_COMPILER_LAUNCHER="",
+			CMAKE_CXX_COMPILER_LAUNCHER="",
+			LLVM_ENABLE_PROJECTS="",
+		)
+		ninja(training_dir, "-t", "clean") # an up-to-date training build would produce no profile at all
+		ninja(training_dir, "LLVMSupport")
+
+		# the instrumented binaries were built by the host clang-cl, which also reads the merged profile back in,
+		# so the profile has to be merged by the llvm-profdata that comes with it
+		compiler = shutil.which("clang-cl")
+		if not compiler:
+			raise Exception("clang-cl not found")
+		if cmd(Path(compiler).with_name("llvm-profdata.exe"), "merge", f"-output={profdata}", *(instrumented_dir/"profiles").glob("*.profraw")) != 0:
+			raise Exception(f"llvm-profdata failed: {instrumented_dir}")
+
+		return profdata
+
+	def configure(self, configs, *, lto=False, pgo=False):
+		self.configure_build(self.build_dir, configs,
+			LLVM_ENABLE_LTO="Thin" if lto else False,
+			LLVM_PROFDATA_FILE=self.profile(configs) if pgo else "",
 		)
 
 	def build(self, configs):
 		ninja(self.build_dir, "install")
 
 	def artifacts(self):
-		with open(self.build_dir/"install_manifest.txt") as file:
-			for l in file:
-				yield Path(l.strip())
+		# plain strings are enough for package(), no need to construct a Path for each of the many entries
+		return (self.build_dir/"install_manifest.txt").read_text().splitlines()
 
 
 def dependencies(this_dir, include):
@@ -118,32 +283,36 @@ def dependencies(this_dir, include):
 
 
 def pull(deps):
-	for dep in deps:
-		dep.pull()
+	with ThreadPoolExecutor(max_workers=len(deps) or 1) as executor:
+		list(executor.map(lambda dep: dep.pull(), deps))
 
 
-def build(deps, *, configs):
+def build(deps, *, configs, **options):
+	# strictly one after the other, later tools are configured using earlier ones (LLVM needs the ninja built before it)
 	for dep in deps:
-		dep.configure(configs)
+		dep.configure(configs, **options)
 		dep.build(configs)
 
 
 def package(this_dir, deps):
-	import tempfile
+	base = str(this_dir)
 
-	for dep in deps:
+	def package_dep(dep):
 		dest = (this_dir/type(dep).__name__).with_suffix(".7z")
 
 		if dest.exists():
 			dest.unlink()
 
+		# 7z cannot read list files from stdin, so go through a temporary file but write it in one go
 		with tempfile.NamedTemporaryFile(delete_on_close=False) as listfile:
-			for a in dep.artifacts():
-				listfile.write(str(a.relative_to(this_dir)).encode())
-				listfile.write(b'\n')
+			listfile.write("\n".join(os.path.relpath(a, base) for a in dep.artifacts()).encode())
 			listfile.close()
 
-			cmd("7z", "a", "-t7z", "-spf", f"-ir@{listfile.name}", dest, cwd=this_dir)
+			cmd("7z", "a", "-t7z", "-mmt=on", "-mx=5", "-ms=on", "-spf", f"-ir@{listfile.name}", dest, cwd=this_dir)
+
+	# 7z is multithreaded itself, so only run as many packaging jobs at once as there are pairs of cores
+	with ThreadPoolExecutor(max_workers=max(min(len(deps), os.cpu_count() // 2), 1)) as executor:
+		list(executor.map(package_dep, deps))
 
 
 def main(args):
@@ -153,7 +322,7 @@ def main(args):
 
 	match args.command:
 		case "pull": pull(deps)
-		case "build": build(deps, configs=args.configs)
+		case "build": build(deps, configs=args.configs, lto=args.lto, pgo=args.pgo)
 		case "package": package(this_dir, deps)
 
 
@@ -179,6 +348,8 @@ def parse_args():
 
 	build_cmd = add_command("build")
 	build_cmd.add_argument("-cfg", "--config", action="append", dest="configs", default=["Release"])
+	build_cmd.add_argument("--lto", action="store_true", help="build LLVM with ThinLTO (installed static libraries will contain bitcode that only an LTO-capable linker can consume)")
+	build_cmd.add_argument("--pgo", action="store_true", help="optimize LLVM using a profile gathered from an instrumented build (reused if it exists)")
 
 	build_cmd = add_command("package")
 
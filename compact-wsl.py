@@ -2,33 +2,58 @@
 import winreg
 import subprocess
 import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+GiB = 2**30
+
+print_lock = threading.Lock()
+
 def distros():
-	with winreg.OpenKeyEx(winreg.HKEY_CURRENT_USER, "Software\\Microsoft\\Windows\\CurrentVersion\\Lxss") as Lxss:
+	access = winreg.KEY_READ | winreg.KEY_WOW64_64KEY # avoid registry redirection when running under 32-bit python
+	with winreg.OpenKeyEx(winreg.HKEY_CURRENT_USER, "Software\\Microsoft\\Windows\\CurrentVersion\\Lxss", 0, access) as Lxss:
 		num_distros, _, _ = winreg.QueryInfoKey(Lxss)
 		for i in range(0, num_distros):
 			distro_subkey = winreg.EnumKey(Lxss, i)
-			with winreg.OpenKey(Lxss, distro_subkey) as distro:
+			with winreg.OpenKeyEx(Lxss, distro_subkey, 0, access) as distro:
 				name, type = winreg.QueryValueEx(distro, "DistributionName")
 				path, type = winreg.QueryValueEx(distro, "BasePath")
-				yield name, Path(path)/"ext4.vhdx"
+			yield name, Path(path)/"ext4.vhdx"
+
+def compact(name, path):
+	before = path.stat().st_size
+	with print_lock:
+		print(name, "at", path)
+	# output is captured and printed in one go so that the progress output of concurrent diskparts doesn't interleave
+	p = subprocess.Popen(["diskpart"], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+	output, _ = p.communicate(f"select vdisk file={path}\r\ncompact vdisk\r\nexit".encode())
+	with print_lock:
+		print(output.decode("oem", errors="replace")) # diskpart writes in the console code page
+	if p.returncode != 0:
+		raise Exception(f"diskpart failed: {name}")
+	after = path.stat().st_size
+	with print_lock:
+		print(f"{name}: {before/GiB:.2f} -> {after/GiB:.2f} GiB ({(1 - after/before)*100:.1f}% reclaimed)")
 
 def main(args):
+	selected = []
 	for name, path in distros():
 		if args.distro and name not in args.distro:
 			print("skipping", name)
 			continue
-		print(name, "at", path)
-		print(path.stat().st_size/(1024**3), "GiB")
-		p = subprocess.Popen(["diskpart"], stdin=subprocess.PIPE)
-		p.communicate(f"select vdisk file={path}\r\ncompact vdisk\r\nexit".encode())
-		if p.returncode != 0:
-			raise Exception("diskpart failed")
-		print(path.stat().st_size/(1024**3), "GiB")
+		if not path.exists():
+			print("skipping", name, "(no ext4.vhdx)")
+			continue
+		selected.append((name, path))
+
+	# diskpart locks each vdisk file exclusively, so different disks can be compacted concurrently
+	with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+		list(executor.map(lambda distro: compact(*distro), selected))
 
 
 if __name__ == "__main__":
 	argparser = argparse.ArgumentParser()
 	argparser.add_argument("-d", "--distro", action="append", help="specify distro to compact")
+	argparser.add_argument("-j", "--jobs", type=int, default=2, help="number of disks to compact concurrently")
 	main(argparser.parse_args())